@@ -0,0 +1,292 @@
+#    Unwrapt - cross-platform package system emulator
+#    Copyright (C) 2010 Chris Oliver <chris@excid3.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    Keeps HTTP/1.1 connections open so they can be reused
+
+    Every package is a small file on the same mirror, so rather than paying
+    for a new TCP connection (and proxy handshake) on every request the
+    connections are handed back to a pool once a response has been read and
+    picked up again by the next request to the same host.
+
+    pool = get_pool(proxy, username, password)
+    response = pool.open("http://archive.ubuntu.com/ubuntu/dists/...")
+    data = response.read()
+    response.close()
+"""
+
+
+import base64
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+
+
+# Redirect status codes that are followed
+REDIRECTS = [301, 302, 303, 307, 308]
+
+# Most redirects followed for a single request
+MAX_REDIRECTS = 5
+
+# Bodies left unread up to this size are read to keep the connection open
+DRAIN_LIMIT = 65536
+
+
+class InvalidCredentials(Exception):
+    """
+        Exception raised if the proxy credentials are invalid
+    """
+
+    pass
+
+
+class PooledResponse:
+    """
+        Wraps an httplib.HTTPResponse and hands its connection back to the
+        pool when it is closed
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+
+    def close(self):
+        if not self.connection:
+            return
+
+        response = self.response
+        reusable = not response.will_close
+        drained = False
+
+        # The connection can only be used again once the body has been read
+        try:
+            if reusable and not response.isclosed():
+                if response.length is not None and \
+                   response.length <= DRAIN_LIMIT:
+                    response.read()
+                else:
+                    reusable = False
+            drained = True
+        finally:
+            # The connection is always handed back, or the next request to
+            # the host could wait for it forever
+            if drained and reusable and response.isclosed():
+                self.pool.release(self.key, self.connection)
+            else:
+                self.connection.close()
+                self.pool.release(self.key, None)
+
+            self.connection = None
+
+
+class ConnectionPool:
+    """
+        A pool of keep-alive connections, per_host is the most connections
+        opened to a single host (or proxy) at the same time
+    """
+
+    def __init__(self, proxy={}, username=None, password=None, per_host=2):
+        if proxy is None:
+            proxy = urllib.getproxies()
+
+        self.proxy = proxy
+        self.username = username
+        self.password = password
+        self.per_host = per_host
+
+        self.lock = threading.Condition()
+        self.idle = {}
+        self.busy = {}
+
+
+    def __route(self, scheme, netloc):
+        """
+            Returns the pool key, a function creating a new connection and
+            any headers every request on it needs
+        """
+
+        proxy = self.proxy.get(scheme)
+        host = netloc.split(":")[0]
+        if proxy and not urllib.proxy_bypass(host):
+            proxy_netloc = urlparse.urlsplit(proxy)[1]
+
+            # Credentials may be part of the proxy url
+            username, password = self.username, self.password
+            if "@" in proxy_netloc:
+                credentials, proxy_netloc = proxy_netloc.rsplit("@", 1)
+                if not username:
+                    username, password = \
+                        (credentials.split(":", 1) + [""])[:2]
+                    username = urllib.unquote(username)
+                    password = urllib.unquote(password)
+
+            headers = {}
+            if username:
+                headers["Proxy-Authorization"] = "Basic %s" % \
+                    base64.b64encode("%s:%s" % (username, password or ""))
+
+            # https has to be tunneled through the proxy
+            if scheme == "https":
+                def connect():
+                    connection = httplib.HTTPSConnection(proxy_netloc)
+                    connection.set_tunnel(netloc, headers=headers)
+                    return connection
+                return (("https", proxy_netloc, netloc), connect, {})
+
+            connect = lambda: httplib.HTTPConnection(proxy_netloc)
+            return (("proxy", proxy_netloc), connect, headers)
+
+        if scheme == "https":
+            connect = lambda: httplib.HTTPSConnection(netloc)
+        else:
+            connect = lambda: httplib.HTTPConnection(netloc)
+        return ((scheme, netloc), connect, {})
+
+
+    def acquire(self, key, connect):
+        """
+            Returns a tuple of a connection for key and whether it was reused,
+            waiting if per_host connections are already in use
+        """
+
+        self.lock.acquire()
+        try:
+            while self.busy.get(key, 0) >= self.per_host:
+                self.lock.wait()
+            self.busy[key] = self.busy.get(key, 0) + 1
+
+            if self.idle.get(key):
+                return (self.idle[key].pop(), True)
+        finally:
+            self.lock.release()
+
+        return (connect(), False)
+
+
+    def release(self, key, connection):
+        """
+            Hand a connection back, None if it was closed
+        """
+
+        self.lock.acquire()
+        try:
+            self.busy[key] -= 1
+            if connection:
+                self.idle.setdefault(key, []).append(connection)
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+
+    def request(self, method, url, headers={}):
+        """
+            Sends a single request and returns a PooledResponse, which must
+            be closed when done with
+        """
+
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        key, connect, extra = self.__route(scheme, netloc)
+
+        # Requests through a plain proxy use the full url
+        if key[0] == "proxy":
+            target = urlparse.urlunsplit((scheme, netloc, path, query, ""))
+        else:
+            target = urlparse.urlunsplit(("", "", path or "/", query, ""))
+
+        headers = dict(headers)
+        headers.update(extra)
+
+        while 1:
+            connection, reused = self.acquire(key, connect)
+            try:
+                connection.request(method, target, headers=headers)
+                response = connection.getresponse(buffering=True)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                self.release(key, None)
+
+                # The server may have closed a connection that sat idle,
+                # try once more on a fresh one
+                if reused:
+                    continue
+                raise
+
+            return PooledResponse(self, key, connection, response)
+
+
+    def open(self, url, headers={}, method="GET"):
+        """
+            Like request but follows redirects and checks proxy credentials
+        """
+
+        for i in range(MAX_REDIRECTS + 1):
+            response = self.request(method, url, headers)
+
+            if response.status == 407:
+                response.close()
+                raise InvalidCredentials, "Unable to authenticate to proxy"
+
+            location = response.headers.getheader("Location")
+            if not response.status in REDIRECTS or not location:
+                return response
+
+            response.close()
+            url = urlparse.urljoin(url, location)
+
+        raise IOError, ("http error", response.status, "Too many redirects")
+
+
+# One pool for every proxy configuration
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(proxy={}, username=None, password=None, per_host=None):
+    """
+        Returns the shared ConnectionPool for a proxy configuration
+    """
+
+    if proxy is None:
+        key = None
+    else:
+        key = tuple(sorted(proxy.items()))
+    key = (key, username, password)
+
+    pools_lock.acquire()
+    try:
+        if not key in pools:
+            pools[key] = ConnectionPool(proxy, username, password)
+        pool = pools[key]
+        if per_host:
+            pool.per_host = per_host
+    finally:
+        pools_lock.release()
+
+    return pool
@@ -151,11 +151,14 @@ class DefinitionBase:
         
 
     @callback
-    def set_status(self, status):
+    def set_status(self, status, merge=False):
         """
-            set_status(status)
+            set_status(status, merge=False)
             
             - status is the filename containing the package statuses
+            - merge keeps the packages marked to be downloaded or installed
+              until the marked version is installed, and only updates the
+              packages that changed in the file.
             
             Sets the package statuses from the offline machine
             
@@ -168,9 +171,9 @@ class DefinitionBase:
 
 
     @callback        
-    def update(self, reporthook=None, directory=None, download=True):
+    def update(self, reporthook=None, directory=None, download=True, processes=1):
         """
-            update(reporthook=None, directory=None, download=True)
+            update(reporthook=None, directory=None, download=True, processes=1)
             
             - reporthook is a function name that will be called to report the 
               progress of files as they are being downloaded. If omitted, the
@@ -181,6 +184,10 @@ class DefinitionBase:
             - download is a boolean to determine if files are downloaded or not
               This is useful for machines that are offline and packages are
               going to be marked and downloaded later on.
+
+            - processes is the number of processes used to read the package
+              lists, at most one per processor. Lists are read one after
+              another when it is 1.
         
             Updates the list of available packages
         
@@ -232,7 +239,8 @@ class DefinitionBase:
             
             - package is the name of the package. 
             
-            This function will return a list of available package versions.
+            This function will return a list of available package versions,
+            newest first.
             
             For example:
             
@@ -269,7 +277,8 @@ class DefinitionBase:
             - package is the name of the package.
             
             This function will mark a package and any necessary dependencies to
-            be downloaded when apply_changes is called.
+            be downloaded when apply_changes is called. It returns a list of
+            every package it marked.
             
             For example:
             
@@ -278,16 +287,101 @@ class DefinitionBase:
         """
         
         pass
+
+
+    @callback
+    def mark_packages(self, packages):
+        """
+            mark_packages(packages)
+            
+            - packages is a list of package metadata.
+            
+            This function will mark every package in the list and their
+            dependencies in a single pass, so dependencies they share are only
+            worked out once. A package that cannot be marked does not stop the
+            others. It returns a dictionary of the names of the packages that
+            could not be marked and the reason why.
+            
+            For example:
+            
+            packages = [client.get_latest_binary(name) for name in names]
+            failures = client.mark_packages(packages)
+        """
+        
+        pass
+        
+
+    @callback
+    def mark_all_upgrades(self):
+        """
+            mark_all_upgrades()
+            
+            This function will mark the newest version of every installed
+            package that is out of date, along with any new dependencies, in
+            a single pass. It returns a list of every package it marked.
+            
+            For example:
+            
+            client.update()
+            client.mark_all_upgrades()
+            client.apply_changes()
+        """
+        
+        pass
+        
+
+    @callback
+    def get_reverse_dependencies(self, package):
+        """
+            get_reverse_dependencies(package)
+            
+            - package is the name of the package.
+            
+            This function will return a list of the metadata of available and
+            installed packages that depend on the package, directly or through
+            something it provides.
+            
+            For example:
+            
+            for metadata in client.get_reverse_dependencies("libc6"):
+                print metadata["Package"], metadata["Version"]
+        """
+        
+        pass
+        
+
+    @callback
+    def get_package_dependencies(self, package):
+        """
+            get_package_dependencies(package)
+            
+            - package is the metadata of the package.
+            
+            This function will return the dependencies of a package as a list
+            of groups, any one option of a group satisfies it. Each option is
+            a tuple of (name, comparison, version) where comparison and version
+            are None if any version will do.
+            
+            For example:
+            
+            package = client.get_latest_binary("firefox")
+            for options in client.get_package_dependencies(package):
+                print " | ".join([name for name, comparison, version in options])
+        """
+        
+        pass
         
     
     @callback
-    def apply_changes(self, reporthook=None, callback=None):
+    def apply_changes(self, reporthook=None, callback=None, workers=4):
         """
-            apply_changes(reporthook=None)
+            apply_changes(reporthook=None, callback=None, workers=4)
             
             - reporthook is a function name that will be called to report the 
               progress of files as they are being downloaded. If omitted, the
               function will print out progress into the console.
+
+            - workers is the number of packages downloaded at the same time.
             
             This function will download marked packages and change their status
             from "to be downloaded" to "to be installed".
@@ -316,6 +410,9 @@ class DefinitionBase:
             When implementing this function, it should write data in EXACTLY
             the same format as it was read in from the operating system.
             
+            Saving again to the same file may only record what changed since
+            the last save, set_status reads those changes back in.
+            
             For example:
             
             client.save_changes("keryx_status")
@@ -325,9 +422,9 @@ class DefinitionBase:
         
         
     @callback
-    def install(self, reporthook=None, callback=None, root="gksu", status="/var/lib/dpkg/status"):
+    def install(self, reporthook=None, callback=None, root="gksu", status="/var/lib/dpkg/status", local_repository=False):
         """
-            install(root="gksu", reporthook=None)
+            install(root="gksu", reporthook=None, local_repository=False)
             
             - directory is the location of the downloaded packages and lists.
               It must have the following folder structure:
@@ -345,6 +442,11 @@ class DefinitionBase:
             - reporthook is the name of a function that will report the
               progress of installation.
               
+            - local_repository installs the packages straight from the
+              packages folder, which is made into a repository holding only
+              the marked packages, instead of copying the lists and packages
+              into the system folders first.
+              
             This function will install the packages that are marked as
             "to be installed"
             
@@ -15,58 +15,26 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import logging
 import os
+import Queue
 import sys
-import urllib
-import httplib
-import urlparse
+import threading
 
-from datetime import datetime
+from email.utils import formatdate, mktime_tz, parsedate_tz
 
+from ConnectionPool import InvalidCredentials, get_pool
 from utils import format_number
 
 
-#TODO: Add resume support: http://code.activestate.com/recipes/83208-resuming-download-of-a-file/
-
-
-class InvalidCredentials(Exception):
-    """
-        Exception raised if the proxy credentials are invalid
-    """
-    
-    pass
-
-class ProxyOpener(urllib.FancyURLopener):
-    """
-        Class for handling proxy credentials
-    """
-    
-    def __init__(self, proxy={}, usr=None, pwd=None):
-        urllib.FancyURLopener.__init__(self, proxy)
-        self.count = 0
-        self.proxy = proxy
-        self.usr = usr
-        self.pwd = pwd
-        
-    def prompt_user_passwd(self, host, realm):
-        """
-            Override the FancyURLopener prompt and simply return what was given
-            Raise an error if there is a problem
-        """
-        
-        self.count += 1
-        
-        if self.count > 1:
-            raise InvalidCredentials, "Unable to authenticate to proxy"
-                    
-        return (self.usr, self.pwd)
-
-        
 def textprogress(display, current, total):
     """
         Download progress in terminal
     """
-    percentage = current/float(total) * 100
+    if total:
+        percentage = current/float(total) * 100
+    else:
+        percentage = 100
     
     sys.stdout.write("\r%-56.56s %3i%% [%5sB / %5sB]" % \
         (display,
@@ -83,90 +51,218 @@ def textprogress(display, current, total):
 
 
 
-def download_url(url, filename, display=None, progress=textprogress, proxy={}, username=None, password=None):
+def http_date(timestamp):
     """
-        Downloads a file to ram and returns a string of the contents
+        Formats a timestamp for use in HTTP headers
+    """
+
+    return formatdate(timestamp, usegmt=True)
+
+
+def download_url(url, filename, display=None, progress=textprogress, proxy={}, username=None, password=None, size=None):
+    """
+        Downloads url to filename in a single request
+
+        A file that is already complete is only downloaded again if it was
+        modified on the server. Unfinished downloads are kept in filename.part
+        and resumed as long as the file on the server has not changed since.
+
+        size is the expected size of the file in bytes, a file of any other
+        size is never taken to be complete
     """
     
     if not display:
         display = url.rsplit("/", 1)[1]
 
-    # Do we already have a file to continue off of?
-    # modified determines whether the file is outdated or not based on headers
-    modified = None
+    partial = "%s.part" % filename
+
+    # Both files carry the Last-Modified date of the server's copy, so the
+    # server can decide whether ours is still usable
+    headers = {}
     downloaded = 0
-    if os.path.exists(filename):
-        modified = datetime.utcfromtimestamp(os.stat(filename).st_mtime)
-        downloaded = os.path.getsize(filename)
-
-    # Open up a temporary connection to see if the file we have downloaded
-    # is still usable (based on modification date)
-    # format meanings are located http://docs.python.org/library/time.html
-    opener = ProxyOpener(proxy, username, password)
-    headers = opener.open(url).headers
-
-    if modified and "Last-Modified" in headers:
-        dt = datetime.strptime(headers["Last-Modified"],
-                                        "%a, %d %b %Y %H:%M:%S %Z")
-       
-        # File is too old so we delete the old file 
-        if modified < dt:
-            #logging.debug("OLD FILE")
-            #print "OLD FILE"
-            downloaded = 0
-            os.remove(filename)
+    if os.path.exists(partial):
+        downloaded = os.path.getsize(partial)
+        headers["Range"] = "bytes=%i-" % downloaded
+        headers["If-Range"] = http_date(os.stat(partial).st_mtime)
+    elif os.path.exists(filename):
+        # A file that was only partly written can still be newer than the
+        # server's copy, so only ask whether it changed if the size is right
+        if size is None or os.path.getsize(filename) == size:
+            headers["If-Modified-Since"] = http_date(os.stat(filename).st_mtime)
 
-    # Test existing filesize compared to length of download
-    if "Content-Length" in headers:
-        length = int(headers["Content-Length"])
+    # Connections are kept open and shared between files
+    page = get_pool(proxy, username, password).open(url, headers)
 
-        # File already downloaded?
-        if downloaded == length:
+    # Whatever goes wrong the connection has to go back to the pool
+    try:
+        # Our copy is up to date
+        if page.status == 304:
+            page.close()
+            length = os.path.getsize(filename)
             progress("Hit: %s" % display, length, length)
             return
 
-        # File corrupted?
-        elif downloaded > length:
+        # Nothing left to resume, the partial file was already complete
+        # unless it is larger than the file on the server
+        if page.status == 416:
+            page.close()
+            length = page.headers.getheader("Content-Range", "").rsplit("/", 1)[-1]
+            if length == str(downloaded) and size in [None, downloaded]:
+                os.rename(partial, filename)
+                progress("Hit: %s" % display, downloaded, downloaded)
+                return
+
+            os.remove(partial)
+            return download_url(url, filename, display, progress, proxy, username, password, size)
+
+        if page.status >= 400:
+            raise IOError, ("http error", page.status, page.reason)
+
+        # The file changed since the partial download, start over
+        if page.status != 206:
             downloaded = 0
-            os.remove(filename)
-
-    # Open up the real connection for downloading
-    opener = ProxyOpener(proxy, username, password)
-    if downloaded:
-        opener.addheader("Range", "bytes=%s-" % str(downloaded))
-    page = opener.open(url)
-
-    # The file range must have matched the download size
-    if not "Content-Length" in page.headers:
-        progress("Hit: %s" % display, downloaded, downloaded)
-        return
-
-    # Finish downloading the file
-    length = int(page.headers["Content-Length"]) + downloaded
-    f = open(filename, "ab")
-
-    while 1:
-        data = page.read(8192)
-        if not data:
-            break
-        downloaded += len(data)
-        f.write(data)
-        progress(display, downloaded, length)
-    f.close()
-    page.close()
+
+        modified = page.headers.getheader("Last-Modified")
+        if modified:
+            modified = parsedate_tz(modified)
+        if modified:
+            modified = mktime_tz(modified)
+
+        # Finish downloading the file
+        if "Content-Length" in page.headers:
+            length = int(page.headers["Content-Length"]) + downloaded
+        else:
+            length = None
+
+        if downloaded:
+            f = open(partial, "ab")
+        else:
+            f = open(partial, "wb")
+
+        try:
+            while 1:
+                data = page.read(8192)
+                if not data:
+                    break
+                downloaded += len(data)
+                f.write(data)
+                progress(display, downloaded, length or downloaded)
+        finally:
+            f.close()
+
+            # Remember which version of the file this is
+            if modified:
+                os.utime(partial, (modified, modified))
+    finally:
+        page.close()
+
+    if length and downloaded < length:
+        raise IOError, ("incomplete download", url)
+
+    # Start over next time rather than resume a file that is wrong
+    if size is not None and downloaded != size:
+        os.remove(partial)
+        raise IOError, ("size mismatch", url, downloaded, size)
+
+    os.rename(partial, filename)
+    if modified:
+        os.utime(filename, (modified, modified))
 
     return
 
+
+def download_urls(downloads, progress=textprogress, proxy={}, username=None, password=None, workers=4, per_host=2, finished=None):
+    """
+        Downloads several files at once
+
+        - downloads is a list of (url, filename, size) tuples, size is the
+          expected size in bytes and may be None. A file of another size is
+          downloaded again.
+
+        - workers is the number of files downloaded at the same time and
+          per_host is the most connections opened to any one host
+
+        - finished is called with the index of each download as it completes
+
+        progress receives the progress of each file as well as the overall
+        progress every time a file completes. If any download fails the first
+        error is raised once the others are done.
+    """
+
+    # Reports come in from every worker, pass them on one at a time
+    lock = threading.Lock()
+
+    def report(display, current, total):
+        lock.acquire()
+        try:
+            progress(display, current, total)
+        finally:
+            lock.release()
+
+    # The pool keeps the connections to each host down to per_host
+    get_pool(proxy, username, password, per_host)
+
+    total = sum([size or 0 for url, filename, size in downloads])
+    done = {"count": 0, "bytes": 0}
+    errors = []
+
+    queue = Queue.Queue()
+    for index, value in enumerate(downloads):
+        queue.put((index, value))
+
+    def worker():
+        while 1:
+            try:
+                index, value = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            url, filename, size = value
+
+            try:
+                download_url(url, filename, progress=report, proxy=proxy,
+                             username=username, password=password, size=size)
+            except Exception, e:
+                logging.error("Unable to download %s: %s" % (url, e))
+                lock.acquire()
+                errors.append(e)
+                lock.release()
+                continue
+
+            lock.acquire()
+            try:
+                done["count"] += 1
+                done["bytes"] += size or 0
+                if finished:
+                    finished(index)
+                progress("Downloaded %i of %i files" % (done["count"],
+                                                        len(downloads)),
+                         done["bytes"], total)
+            finally:
+                lock.release()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(downloads)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
 ##Check for Valid URL based on the HTTP response code
-def httpExists(url):
-    host, path = urlparse.urlsplit(url)[1:3]
+def httpExists(url, proxy={}, username=None, password=None):
     found = False
-    connection = httplib.HTTPConnection(host)  ## Make HTTPConnection Object
     try:
-        connection.request("HEAD", path)
-        responseOb = connection.getresponse()      ## Grab HTTPResponse Object
-        if responseOb.status == 200:
+        response = get_pool(proxy, username, password).open(url, method="HEAD")
+        response.close()
+        if response.status == 200:
             found = True
+    except InvalidCredentials:
+        raise
     except:
         pass
         
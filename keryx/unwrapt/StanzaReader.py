@@ -0,0 +1,225 @@
+#    Unwrapt - cross-platform package system emulator
+#    Copyright (C) 2010 Chris Oliver <chris@excid3.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    Reads Debian control stanzas (Packages and status files) out of a buffer
+
+    Instead of handling the file a line at a time, the whole buffer is split
+    on blank lines and all fields of a stanza, continuation lines included, are
+    picked out with a single findall. The continuation of Description is the
+    long description.
+
+    >>> data = "Package: bash\\nDescription: shell\\n GNU shell\\n\\n"
+    >>> for offset, fields, span in read_stanzas(data):
+    ...     print fields["Package"], repr(data[offset + span[0]:offset + span[1]])
+    bash ' GNU shell\\n'
+"""
+
+
+import re
+
+
+# A field followed by any continuation lines, which start with a space or tab
+field_lines = re.compile(r"^([^ \t\n:][^:\n]*):[ \t]*([^\n]*(?:\n[ \t][^\n]*)*)",
+                         re.M)
+
+# Whitespace that values need to be stripped of
+trailing_space = [" \n", "\t\n", "\r"]
+
+# The start of a field's value, by field name
+value_starts = {}
+
+# The blank lines between stanzas when lines end in a carriage return
+crlf_blank_lines = re.compile(r"\n(?:\r?\n)+")
+
+
+def read_stanzas(data, long_field="Description"):
+    """
+        Yields a tuple of the offset, fields and long description span of
+        every stanza in data, see parse_stanza
+
+        The last stanza does not need a blank line after it and lines may
+        end in a carriage return
+
+        >>> [fields for offset, fields, span in read_stanzas("Package: a\\n")]
+        [{'Package': 'a'}]
+        >>> data = "Package: a\\r\\nVersion: 1\\r\\n\\r\\nPackage: b\\r\\n"
+        >>> [sorted(fields.items()) for offset, fields, span in read_stanzas(data)]
+        [[('Package', 'a'), ('Version', '1')], [('Package', 'b')]]
+    """
+
+    # Trailing whitespace is rare, so find it once for the whole buffer and
+    # only strip the values of the stanzas that have some
+    marks = []
+    for space in trailing_space:
+        idx = data.find(space)
+        while idx != -1:
+            marks.append(idx)
+            idx = data.find(space, idx + 1)
+    marks.sort()
+    # Past the end of the last stanza, which may run to the end of data
+    marks.append(len(data) + 1)
+    mark = 0
+
+    for offset, text in iter_stanzas(data):
+        end = offset + len(text)
+        strip = marks[mark] <= end or text[-1] in " \t"
+        while marks[mark] <= end:
+            mark += 1
+
+        fields, span = parse_stanza(text, long_field, strip)
+        yield (offset, fields, span)
+
+
+def iter_stanzas(data):
+    """
+        Yields a tuple of the offset and text of each stanza in data
+    """
+
+    if "\r" in data:
+        for stanza in iter_crlf_stanzas(data):
+            yield stanza
+        return
+
+    offset = 0
+    for text in data.split("\n\n"):
+        start = offset
+        offset += len(text) + 2
+
+        # More than one blank line between stanzas
+        if text.startswith("\n"):
+            stripped = text.lstrip("\n")
+            start += len(text) - len(stripped)
+            text = stripped
+
+        if text:
+            yield (start, text)
+
+
+def iter_crlf_stanzas(data):
+    """
+        Like iter_stanzas but the blank lines may hold a carriage return
+    """
+
+    offset = 0
+    ends = [(match.start(), match.end())
+            for match in crlf_blank_lines.finditer(data)]
+    for end, following in ends + [(len(data), len(data))]:
+        text = data[offset:end]
+        stripped = text.lstrip("\r\n")
+        if stripped:
+            yield (offset + len(text) - len(stripped), stripped)
+        offset = following
+
+
+def parse_stanza(text, long_field="Description", strip=None):
+    """
+        Takes the text of a single stanza
+
+        returns a tuple of a dictionary of its fields and the (start, end)
+        of the continuation lines of long_field relative to text, or None if
+        there are none. The end includes the final newline.
+
+        Values are stripped if strip is True, or if strip is None and the
+        stanza has any trailing whitespace.
+    """
+
+    fields = dict(field_lines.findall(text))
+
+    # The long description is split off its field and only its position is
+    # returned so callers can decide whether to keep a copy
+    span = None
+    value = fields.get(long_field)
+    if value and "\n" in value:
+        idx = value.index("\n")
+        fields[long_field] = value[:idx]
+
+        if not long_field in value_starts:
+            value_starts[long_field] = re.compile(r"^%s:[ \t]*" % \
+                                                  re.escape(long_field), re.M)
+        start = value_starts[long_field].search(text).end()
+        span = (start + idx + 1, start + len(value) + 1)
+
+    if strip is None:
+        strip = text[-1] in " \t"
+        for space in trailing_space:
+            strip = strip or space in text
+
+    if strip:
+        for key, value in fields.items():
+            fields[key] = value.strip()
+
+    return (fields, span)
+
+
+def _parse_lines(f):
+    """
+        The line at a time parser this module replaces, kept for comparison
+    """
+
+    stanzas = []
+    current = {}
+    for line in f:
+        if line.startswith("\n"):
+            if current:
+                stanzas.append(current)
+            current = {}
+        elif line.startswith(" ") or line.startswith("\t"):
+            if "Long" in current:
+                current["Long"] += line
+            else:
+                current["Long"] = line
+        else:
+            try:
+                key, value = line.split(": ", 1)
+                current[key] = value.strip()
+            except ValueError:
+                pass
+
+    return stanzas
+
+
+if __name__ == "__main__":
+    # Benchmark against the line at a time parser
+    #   python StanzaReader.py /var/lib/apt/lists/..._Packages
+    import gzip
+    import sys
+    import time
+
+    filename = sys.argv[1]
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "rb")
+    else:
+        f = open(filename, "rb")
+    data = f.read()
+    f.close()
+
+    lines = data.count("\n")
+
+    begin = time.time()
+    count = len(_parse_lines(data.splitlines(True)))
+    elapsed = time.time() - begin
+    print "line parser:    %6i stanzas %10i lines/s" % (count, lines / elapsed)
+
+    begin = time.time()
+    count = 0
+    for offset, fields, span in read_stanzas(data):
+        if span:
+            fields["Long"] = data[offset + span[0]:offset + span[1]]
+        count += 1
+    elapsed = time.time() - begin
+    print "stanza reader:  %6i stanzas %10i lines/s" % (count, lines / elapsed)
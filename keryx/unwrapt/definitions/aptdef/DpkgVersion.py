@@ -13,6 +13,8 @@ __author__    = "Scott James Remnant <scott@netsplit.com>"
 
 import re
 
+from utils import LRUCache
+
 
 # Regular expressions make validating things easy
 valid_epoch = re.compile(r'^[0-9]+$')
@@ -22,6 +24,16 @@ valid_revision = re.compile(r'^[A-Za-z0-9+.~]+$')
 # Character comparison table for upstream and revision components
 cmp_table = "~ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.:"
 
+# Sort order of each character, the end of a string sorts as 0
+deb_orders = dict([(c, cmp_table.index(c)) for c in cmp_table])
+deb_orders["~"] = -1
+
+# A run of non-digits followed by a run of digits
+deb_parts = re.compile(r'([^0-9]*)([0-9]*)')
+
+# The most recently parsed versions, see parse_version
+parsed_versions = LRUCache(8192)
+
 
 class VersionError(Exception): pass
 class BadInputError(VersionError): pass
@@ -43,15 +55,20 @@ class DpkgVersion(object):
      - epoch: Epoch
      - upstream: Upstream version
      - revision: Debian/local revision
+     - key: Tuple that sorts in the same order as the version
+
+    Versions are immutable so parse_version can share a single instance
+    between everyone asking for the same version string.
     """
 
+    __slots__ = ["epoch", "upstream", "revision", "key"]
+
     allowed_types = ["<<", "<=", "=", ">=", ">>"]
 
     def __init__(self, ver):
         """Parse a string or number into the three components."""
-        self.epoch = None
-        self.upstream = None
-        self.revision = None
+        epoch = None
+        revision = None
 
         ver = str(ver)
         if not len(ver):
@@ -60,32 +77,51 @@ class DpkgVersion(object):
         # Epoch is component before first colon
         idx = ver.find(":")
         if idx != -1:
-            self.epoch = ver[:idx]
-            if not len(self.epoch):
+            epoch = ver[:idx]
+            if not len(epoch):
                 raise BadEpochError, "Epoch cannot be empty"
-            if not valid_epoch.search(self.epoch):
+            if not valid_epoch.search(epoch):
                 raise BadEpochError, "Bad epoch format"
             ver = ver[idx+1:]
 
         # Revision is component after last hyphen
         idx = ver.rfind("-")
         if idx != -1:
-            self.revision = ver[idx+1:]
-            if not len(self.revision):
+            revision = ver[idx+1:]
+            if not len(revision):
                 raise BadRevisionError, "Revision cannot be empty"
-            if not valid_revision.search(self.revision):
+            if not valid_revision.search(revision):
                 raise BadRevisionError, "Bad revision format"
             ver = ver[:idx]
 
         # Remaining component is upstream
-        self.upstream = ver
-        if not len(self.upstream):
+        upstream = ver
+        if not len(upstream):
             raise BadUpstreamError, "Upstream version cannot be empty"
-        if not valid_upstream.search(self.upstream):
+        if not valid_upstream.search(upstream):
             raise BadUpstreamError, "Bad upstream version format"
 
-        if self.epoch is not None:
-            self.epoch = int(self.epoch)
+        if epoch is not None:
+            epoch = int(epoch)
+
+        setattr = object.__setattr__
+        setattr(self, "epoch", epoch)
+        setattr(self, "upstream", upstream)
+        setattr(self, "revision", revision)
+
+        # Comparisons come down to comparing these tuples
+        setattr(self, "key", (epoch or 0, deb_key(upstream),
+                              deb_key(revision or "")))
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "DpkgVersion objects are immutable"
+
+    def __delattr__(self, name):
+        raise AttributeError, "DpkgVersion objects are immutable"
+
+    def __reduce__(self):
+        """Unpickle through parse_version."""
+        return (parse_version, (str(self),))
 
     def getWithoutEpoch(self):
         """Return the version without the epoch."""
@@ -114,27 +150,21 @@ class DpkgVersion(object):
 
     def __cmp__(self, other):
         """Compare two Version classes."""
-        other = DpkgVersion(other)
-
-        # Compare epochs only if they are not equal.
-        if self.epoch != other.epoch:
-            # Special cases for braindead packages
-            sepoch = self.epoch
-            oepoch = other.epoch
-            if sepoch is None:
-                sepoch = 0
-            if oepoch is None:
-                oepoch = 0
-            result = cmp(sepoch, oepoch)
-            if result != 0: return result
-
-        result = deb_cmp(self.upstream, other.upstream)
-        if result != 0: return result
+        if not isinstance(other, DpkgVersion):
+            other = parse_version(other)
 
-        result = deb_cmp(self.revision or "", other.revision or "")
-        if result != 0: return result
+        return cmp(self.key, other.key)
 
-        return 0
+    def __lt__(self, other):
+        """Sorting only needs less than, skip cmp for it."""
+        if not isinstance(other, DpkgVersion):
+            other = parse_version(other)
+
+        return self.key < other.key
+
+    def __hash__(self):
+        """Equal versions such as 0:1.0 and 1.0 hash the same."""
+        return hash(self.key)
 
     def is_native(self):
         native = False
@@ -161,6 +191,56 @@ class DpkgVersion(object):
         else:
             raise AttributeError, "This should never happen"
 
+def parse_version(ver):
+    """Return the shared DpkgVersion for a version string.
+
+    Recently parsed versions are kept in parsed_versions, whose hits and
+    misses count how often a version was parsed again.
+    """
+    if isinstance(ver, DpkgVersion):
+        return ver
+
+    version = parsed_versions.get(ver)
+    if version is None:
+        version = DpkgVersion(ver)
+        parsed_versions[ver] = version
+
+    return version
+
+def version_key(item):
+    """Return the sort key of a version string, DpkgVersion or package.
+
+    Packages are anything with a Version item, such as the records read from
+    the package lists.
+    """
+    if isinstance(item, DpkgVersion):
+        return item.key
+    elif isinstance(item, basestring):
+        return parse_version(item).key
+    else:
+        return parse_version(item["Version"]).key
+
+def sort_versions(items, reverse=False):
+    """Return a list of version strings, DpkgVersions or packages sorted
+    oldest first, or newest first if reverse is True.
+
+    Every item is parsed once and the sort compares keys, equal versions
+    keep the order they were given in.
+
+    >>> sort_versions(["1.0-1", "1:0.9", "1.0~rc1"])
+    ['1.0~rc1', '1.0-1', '1:0.9']
+    """
+    return sorted(items, key=version_key, reverse=reverse)
+
+def max_version(items):
+    """Return the newest of a list of version strings, DpkgVersions or
+    packages, the first one given if several are equal.
+
+    >>> max_version(["1.0", "1.0-0", "0.9"])
+    '1.0'
+    """
+    return max(items, key=version_key)
+
 def strcut(str, idx, accept):
     """Cut characters from str that are entirely in accept."""
     ret = ""
@@ -210,3 +290,72 @@ def deb_cmp(x, y):
         if result != 0: return result
 
     return 0
+
+def deb_key(x):
+    """Return a tuple that sorts the same way as x does under deb_cmp.
+
+    Each run of non-digits and the run of digits after it become a pair of
+    the character orders and the number. deb_cmp treats a string that has run
+    out as empty runs, so the key ends with that pair to compare against.
+    Only the first pair can ever equal it, the runs after a number always
+    start with a non-digit.
+    """
+    if not x:
+        return (((0,), 0), ((0,), 0))
+
+    # findall ends with the empty match at the end of x
+    order = deb_orders.__getitem__
+    return tuple([(tuple(map(order, string)) + (0,), int(number or "0"))
+                  for string, number in deb_parts.findall(x)])
+
+def legacy_cmp(x, y):
+    """Compare two versions the way __cmp__ did before sort keys."""
+    result = cmp(x.epoch or 0, y.epoch or 0)
+    if result != 0: return result
+
+    result = deb_cmp(x.upstream, y.upstream)
+    if result != 0: return result
+
+    return deb_cmp(x.revision or "", y.revision or "")
+
+
+if __name__ == "__main__":
+    # Benchmark sorting every version in a package list
+    #   PYTHONPATH=keryx/unwrapt python DpkgVersion.py /var/lib/apt/lists/..._Packages
+    import gzip
+    import sys
+    import time
+
+    versions = []
+    for filename in sys.argv[1:]:
+        if filename.endswith(".gz"):
+            f = gzip.open(filename, "rb")
+        else:
+            f = open(filename, "rb")
+        versions += re.findall(r"^Version: *(\S+)", f.read(), re.M)
+        f.close()
+
+    begin = time.time()
+    parsed = [DpkgVersion(version) for version in versions]
+    print "parse:        %6i versions %8.3fs" % (len(parsed),
+                                                time.time() - begin)
+
+    begin = time.time()
+    old = sorted(parsed, cmp=legacy_cmp)
+    legacy = time.time() - begin
+    print "deb_cmp sort: %6i versions %8.3fs" % (len(old), legacy)
+
+    begin = time.time()
+    new = sorted(parsed)
+    elapsed = time.time() - begin
+    print "object sort:  %6i versions %8.3fs %6.1fx" % (len(new), elapsed,
+                                                       legacy / elapsed)
+
+    begin = time.time()
+    new = sorted(parsed, key=lambda version: version.key)
+    elapsed = time.time() - begin
+    print "key sort:     %6i versions %8.3fs %6.1fx" % (len(new), elapsed,
+                                                       legacy / elapsed)
+
+    if [legacy_cmp(x, y) for x, y in zip(old, new)] != [0] * len(old):
+        print "Sort orders differ"
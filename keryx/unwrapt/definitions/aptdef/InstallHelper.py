@@ -0,0 +1,161 @@
+#    Unwrapt - cross-platform package system emulator
+#    Copyright (C) 2010 Chris Oliver <chris@excid3.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    Carries out a whole installation as root in a single run
+
+    Rather than asking for the root password for every list that is copied
+    and every command that is run, everything that needs root is written to
+    a manifest which this script is run on once
+
+        gksu "python InstallHelper.py install.manifest"
+
+    The manifest is a JSON file in the following format
+
+    {"lists": [["downloaded list.gz", "/var/lib/apt/lists/..."]],
+     "packages": ["downloaded package.deb"],
+     "archives": "/var/cache/apt/archives",
+     "options": ["Dir::Etc::SourceList=..."],
+     "update": false,
+     "gencaches": true,
+     "install": ["package", "package two"]}
+
+    Progress is written to stdout a line at a time, along with the output of
+    apt-get, so it can be passed on as it happens. The script only relies on
+    the standard library as it is run on its own.
+"""
+
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+
+def report(message):
+    """
+        Write a line of progress and send it on straight away
+    """
+
+    sys.stdout.write("%s\n" % message)
+    sys.stdout.flush()
+
+
+def place_list(source, dest):
+    """
+        Uncompress the downloaded list source to dest
+    """
+
+    # Write next to dest first so apt never sees a partial list
+    temp = "%s.tmp" % dest
+
+    f = gzip.open(source, "rb")
+    out = open(temp, "wb")
+    try:
+        shutil.copyfileobj(f, out, 65536)
+    except IOError:
+        out.close()
+        f.close()
+        os.remove(temp)
+        raise
+    out.close()
+    f.close()
+    os.rename(temp, dest)
+
+
+def apt(command, options, args=[]):
+    """
+        Run an apt command with options, passing its output on as progress
+
+        returns the exit status
+    """
+
+    command = command + ["-o%s" % option for option in options] + args
+    report(" ".join(command))
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, ""):
+        report(line.rstrip("\n"))
+    return process.wait()
+
+
+def run(manifest):
+    """
+        Carry out every step of the manifest in turn
+
+        returns 0 or the exit status of the first command that failed
+    """
+
+    options = manifest.get("options", [])
+
+    lists = manifest.get("lists", [])
+    for i, (source, dest) in enumerate(lists):
+        report("Placing list %i of %i: %s" % (i + 1, len(lists), dest))
+
+        # Like a list that failed to download, apt carries on without it
+        try:
+            place_list(source, dest)
+        except IOError, e:
+            report("Skipping list %s: %s" % (source, e))
+
+    packages = manifest.get("packages", [])
+    if packages:
+        archives = manifest.get("archives", "/var/cache/apt/archives")
+        report("Copying %i packages to %s" % (len(packages), archives))
+        for filename in packages:
+            shutil.copy(filename, archives)
+
+    if manifest.get("update"):
+        status = apt(["apt-get"], options, ["update"])
+        if status:
+            return status
+
+    if manifest.get("gencaches"):
+        status = apt(["apt-cache"], options, ["gencaches"])
+        if status:
+            return status
+
+    install = manifest.get("install", [])
+    if install:
+        return apt(["apt-get"], options, ["install", "-y"] + install)
+
+    return 0
+
+
+def main(args):
+    if len(args) != 1:
+        sys.stderr.write("usage: InstallHelper.py manifest\n")
+        return 2
+
+    f = open(args[0], "rb")
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+
+    try:
+        return run(manifest)
+    except (IOError, OSError), e:
+        report("Error: %s" % e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
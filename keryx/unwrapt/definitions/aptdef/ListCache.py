@@ -0,0 +1,216 @@
+#    Unwrapt - cross-platform package system emulator
+#    Copyright (C) 2010 Chris Oliver <chris@excid3.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    The packages parsed out of each package list are cached in a file of
+    their own next to the list, the list filename with .cache added, in the
+    following format
+
+    {"version": CACHE_VERSION,
+     "list": (size, mtime, md5, [packages])}
+
+    Every project shares the lists directory, so only the caches of the
+    lists a project uses are ever read or written. A list is only parsed
+    again when its size, modification time and md5 no longer match.
+"""
+
+
+import cPickle
+import hashlib
+import logging
+import os
+
+
+# Bump this whenever the format of the cached packages changes
+CACHE_VERSION = 8
+
+# Added to the filename of a list to get the filename of its cache
+CACHE_EXTENSION = ".cache"
+
+
+def file_digest(filename):
+    """
+        Returns the md5 hex digest of a file
+    """
+
+    digest = hashlib.md5()
+
+    f = open(filename, "rb")
+    while 1:
+        data = f.read(65536)
+        if not data:
+            break
+        digest.update(data)
+    f.close()
+
+    return digest.hexdigest()
+
+
+def cache_name(filename):
+    """
+        Returns the filename of the cache of the list filename
+    """
+
+    return filename + CACHE_EXTENSION
+
+
+class ListCache:
+    """
+        On-disk cache of the packages parsed out of each package list
+    """
+
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        self.changed = set()
+
+
+    def load(self, filename):
+        """
+            Read the cache of the list filename in with a single load,
+            returns the entry or None
+        """
+
+        if not filename in self.entries:
+            self.entries[filename] = self.__read(cache_name(filename))
+
+        return self.entries[filename]
+
+
+    def __read(self, name):
+        """
+            Returns the entry stored in the cache file name or None
+        """
+
+        if not os.path.exists(name):
+            return None
+
+        try:
+            f = open(name, "rb")
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            # A corrupted cache is simply rebuilt
+            logging.debug("Unable to read %s: %s" % (name, e))
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+            logging.debug("Discarding outdated cache %s" % name)
+            return None
+
+        return data["list"]
+
+
+    def get(self, filename):
+        """
+            Returns the cached packages for filename or None if the list has
+            changed since it was cached
+        """
+
+        entry = self.load(filename)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        size, mtime, digest, packages = entry
+
+        if stat.st_size != size:
+            return None
+
+        # The list was touched, it may have been downloaded again unchanged
+        if stat.st_mtime != mtime:
+            if file_digest(filename) != digest:
+                return None
+
+            self.entries[filename] = (size, stat.st_mtime, digest, packages)
+            self.changed.add(filename)
+
+        return packages
+
+
+    def set(self, filename, packages, digest=None):
+        """
+            Cache the packages parsed from filename
+        """
+
+        stat = os.stat(filename)
+        if not digest:
+            digest = file_digest(filename)
+
+        self.entries[filename] = (stat.st_size, stat.st_mtime, digest, packages)
+        self.changed.add(filename)
+
+
+    def prune(self):
+        """
+            Remove the caches of any lists that no longer exist
+        """
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        # Only the names are looked at, the caches themselves are not read
+        for name in names:
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+
+            filename = os.path.join(self.directory,
+                                    name[:-len(CACHE_EXTENSION)])
+            if not os.path.exists(filename):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError, e:
+                    logging.debug("Unable to remove %s: %s" % (name, e))
+
+                self.entries.pop(filename, None)
+                self.changed.discard(filename)
+
+
+    def save(self):
+        """
+            Write the caches of the lists that changed back to disk
+        """
+
+        for filename in self.changed:
+            name = cache_name(filename)
+
+            # Write to a temporary file first so an interrupted save never
+            # leaves a truncated cache behind
+            temp = "%s.tmp" % name
+
+            try:
+                f = open(temp, "wb")
+                try:
+                    cPickle.dump({"version": CACHE_VERSION,
+                                  "list": self.entries[filename]},
+                                 f, cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(temp, name)
+            except (IOError, OSError), e:
+                logging.error("Unable to write %s: %s" % (name, e))
+
+        self.changed = set()
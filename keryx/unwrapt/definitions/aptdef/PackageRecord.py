@@ -0,0 +1,241 @@
+#    Unwrapt - cross-platform package system emulator
+#    Copyright (C) 2010 Chris Oliver <chris@excid3.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    A compact, dictionary-like record for a single package stanza
+
+    Every package list holds tens of thousands of stanzas, so instead of a
+    dict per stanza each known field is stored in a slot. Values that repeat
+    across most of the archive (Section, Priority, Maintainer...) are interned
+    so every record shares the same string.
+
+    The long description is the bulk of every stanza but is only ever shown
+    for one package at a time. Records parsed from a list only remember where
+    it is in the uncompressed list and read it back when it is asked for.
+"""
+
+
+import gzip
+import logging
+import os
+
+from utils import LRUCache
+
+
+# Known fields and the slots they are stored in
+FIELDS = ["Package", "Priority", "Section", "Installed-Size", "Maintainer",
+          "Original-Maintainer", "Architecture", "Source", "Version",
+          "Replaces", "Provides", "Depends", "Pre-Depends", "Recommends",
+          "Suggests", "Conflicts", "Breaks", "Enhances", "Filename", "Size",
+          "MD5sum", "SHA1", "SHA256", "Description", "Description-md5",
+          "Homepage", "Bugs", "Origin", "Supported", "Task", "Multi-Arch",
+          "Long", "Status", "Repository"]
+
+SLOTS = dict([(field, field.replace("-", "_")) for field in FIELDS])
+
+# Fields whose values are shared by many packages
+INTERNED = set(["Priority", "Section", "Maintainer", "Original-Maintainer",
+                "Architecture", "Source", "Bugs", "Origin", "Supported",
+                "Task", "Multi-Arch", "Status"])
+
+# The most recently read long descriptions
+descriptions = LRUCache(64)
+
+
+def uncompressed_name(filename):
+    """
+        Returns the filename of the uncompressed copy of a package list
+    """
+
+    if filename.endswith(".gz"):
+        return filename[:-3]
+
+    return filename
+
+
+def read_description(source, offset, length):
+    """
+        Returns length bytes of the uncompressed package list source starting
+        at offset
+    """
+
+    key = (source, offset)
+    text = descriptions.get(key)
+    if text is not None:
+        return text
+
+    # Prefer the uncompressed copy written when the list was parsed, it is
+    # only stale if the list was downloaded again afterwards
+    filename = uncompressed_name(source)
+    try:
+        if filename != source and (not os.path.exists(filename) or \
+           os.path.getmtime(filename) < os.path.getmtime(source)):
+            f = gzip.open(source, "rb")
+        else:
+            f = open(filename, "rb")
+        f.seek(offset)
+        text = f.read(length)
+        f.close()
+    except IOError, e:
+        logging.error("Unable to read description from %s: %s" % (source, e))
+        return ""
+
+    descriptions[key] = text
+    return text
+
+
+class PackageRecord(object):
+    """
+        Stores the fields of a package and supports the usual dict access
+
+        >>> record = PackageRecord({"Package": "bash"})
+        >>> record["Package"]
+        'bash'
+        >>> "Long" in record
+        False
+
+        Fields that are not in FIELDS are kept in a small dict of extras.
+        The long description is either stored in Long or read on demand
+        through set_long.
+    """
+
+    __slots__ = [SLOTS[field] for field in FIELDS] + \
+                ["_extra", "_source", "_offset", "_length", "_depends"]
+
+
+    def __init__(self, fields=None):
+        if fields:
+            # Skip __setitem__ for the known fields, records are created for
+            # every stanza of every list
+            for key, value in fields.iteritems():
+                slot = SLOTS.get(key)
+                if not slot:
+                    self[key] = value
+                    continue
+
+                if key in INTERNED:
+                    value = intern(value)
+                setattr(self, slot, value)
+
+
+    def __getitem__(self, key):
+        slot = SLOTS.get(key)
+        try:
+            if slot:
+                return getattr(self, slot)
+            return self._extra[key]
+        except AttributeError:
+            if key == "Long" and hasattr(self, "_source"):
+                return read_description(self._source, self._offset,
+                                        self._length)
+            raise KeyError, key
+
+
+    def __setitem__(self, key, value):
+        if key in INTERNED and type(value) is str:
+            value = intern(value)
+
+        slot = SLOTS.get(key)
+        if slot:
+            setattr(self, slot, value)
+            return
+
+        try:
+            self._extra[intern(key)] = value
+        except AttributeError:
+            self._extra = {intern(key): value}
+
+
+    def __delitem__(self, key):
+        if key == "Long" and hasattr(self, "_source"):
+            del self._source
+            return
+
+        slot = SLOTS.get(key)
+        try:
+            if slot:
+                delattr(self, slot)
+            else:
+                del self._extra[key]
+        except AttributeError:
+            raise KeyError, key
+
+
+    def __contains__(self, key):
+        slot = SLOTS.get(key)
+        if slot:
+            return hasattr(self, slot) or \
+                   (key == "Long" and hasattr(self, "_source"))
+        return hasattr(self, "_extra") and key in self._extra
+
+    has_key = __contains__
+
+
+    def set_long(self, source, offset, length):
+        """
+            Point the long description at length bytes starting at offset in
+            the uncompressed package list source
+        """
+
+        self._source = source
+        self._offset = offset
+        self._length = length
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        keys = [field for field in FIELDS if field in self]
+        if hasattr(self, "_extra"):
+            keys += self._extra.keys()
+        return keys
+
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__,
+                               self.get("Package"), self.get("Version"))
+
+
+    def __getstate__(self):
+        """
+            Pickle the record as a flat tuple of its slot values
+        """
+
+        return tuple([getattr(self, slot, None) for slot in self.__slots__])
+
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            if value is not None:
+                setattr(self, slot, value)
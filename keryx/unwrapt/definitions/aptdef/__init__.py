@@ -23,21 +23,32 @@
      "package two": [{version1}]}
      
      This allows us to easily find a package, as well as all the versions
+
+     Each version is a PackageRecord, which behaves like a dict but stores its
+     fields in slots to keep the memory usage down.
 """
 
 
+import bisect
 import gzip
+import json
 import logging
+import marshal
+import multiprocessing
 import os
+import re
 import shutil
 import subprocess
 import sys
 
 from DefinitionBase import DefinitionBase
-from Download import download_url, textprogress, httpExists
+from Download import download_url, download_urls, textprogress
+from StanzaReader import iter_stanzas, read_stanzas
 from utils import format_number, to_filename, to_url, url_join
 
-from DpkgVersion import DpkgVersion
+from DpkgVersion import VersionError, parse_version, sort_versions
+from ListCache import ListCache, file_digest
+from PackageRecord import PackageRecord, uncompressed_name
 
 
 info = {"name"   : "apt",
@@ -78,6 +89,442 @@ class InvalidRepository(Exception):
     pass
 
 
+###############################################################################
+# Package List Parsing
+###############################################################################
+
+def read_list(filename, records=True):
+    """
+        Takes the filename of a package list
+
+        returns a tuple of the filename and a list of all packages in the file
+        or None if the list could not be read. Without records the packages
+        are left as returned by parse_list.
+    """
+
+    # Attempt to open the package list.
+    try:
+        # Long descriptions are read back from the uncompressed list later
+        source = uncompressed_name(filename)
+        if source != filename:
+            decompress_list(filename, source)
+
+        f = open(source, "rb")
+        # Parse packages into a list
+        packages = parse_list(f)
+        f.close()
+    except IOError , ioex:
+        # Process the value of Errno and display the respective error message
+        if ioex.errno:
+            # If Errno value is 2, then the file is not exists
+            if ioex.errno == 2:
+                logging.error("\nPackage list does not exist: %s" % filename)
+            else:
+                logging.error("\n%s: %s" % (ioex,filename))
+        else:
+            logging.error("\n%s: %s" % (ioex,filename))
+            # If we receive a corrupted package list delete it
+            os.remove(filename)
+
+        #TODO: Redownload the corrupted list and hope that parses :)
+        return (filename, None)
+
+    if records:
+        packages = make_records(filename, packages)
+
+    return (filename, packages)
+
+
+def read_list_stanzas(filename):
+    """
+        read_list for a process pool, the packages are marshalled
+
+        Pickling a PackageRecord goes through Python code and costs about as
+        much as parsing it, so only the plain fields are sent back and the
+        records are made by the parent. Marshalling them is several times
+        quicker again than pickling them.
+    """
+
+    filename, packages = read_list(filename, False)
+    if packages is not None:
+        packages = marshal.dumps(packages)
+
+    return (filename, packages)
+
+
+def decompress_list(filename, destination):
+    """
+        Writes an uncompressed copy of the gzipped list filename
+    """
+
+    temp = "%s.tmp" % destination
+
+    source = gzip.open(filename, "rb")
+    f = open(temp, "wb")
+    try:
+        shutil.copyfileobj(source, f, 65536)
+    except IOError:
+        # A corrupt list must not leave a partial copy behind
+        f.close()
+        source.close()
+        os.remove(temp)
+        raise
+    f.close()
+    source.close()
+
+    os.rename(temp, destination)
+
+
+def parse_list(f):
+    """
+        Takes an open file of an uncompressed list
+
+        returns a list with a tuple of the fields of every package in file and
+        the offset and length of its long description, or None
+    """
+
+    packages = []
+    data = f.read()
+    for offset, fields, span in read_stanzas(data):
+        if not "Package" in fields:
+            logging.debug(repr(fields))
+            continue
+
+        # Only remember where the long description is, it is read back from
+        # the list when it is needed
+        if span:
+            start, end = span
+            packages.append((fields, offset + start, end - start))
+        else:
+            packages.append((fields, None))
+
+    return packages
+
+
+def make_records(source, packages):
+    """
+        Returns a PackageRecord for each of the packages parse_list returned
+        for the list source
+    """
+
+    records = []
+    for package in packages:
+        record = PackageRecord(package[0])
+        if package[1] is not None:
+            record.set_long(source, package[1], package[2])
+        records.append(record)
+
+    return records
+
+
+###############################################################################
+# Status Parsing
+###############################################################################
+
+# The packages of each status file read, see read_status
+status_cache = {}
+
+# Where the Status of a stanza is
+status_field = re.compile(r"^Status:[ \t]*([^\n]*)", re.M)
+
+
+def read_status(filename, properties, statuses):
+    """
+        Reads the dpkg status file filename
+
+        returns a list with a dictionary of the properties of every package
+        whose Status is in statuses. The packages are kept until the file
+        changes, but each call returns new dictionaries.
+    """
+
+    f = open(filename, "rb")
+    try:
+        stat = os.fstat(f.fileno())
+        key = (stat.st_mtime, stat.st_size, tuple(properties), tuple(statuses))
+
+        if filename in status_cache and status_cache[filename][0] == key:
+            packages = status_cache[filename][1]
+        else:
+            packages = parse_status(f.read(), properties, statuses)
+            status_cache[filename] = (key, packages)
+    finally:
+        f.close()
+
+    return [dict(package) for package in packages]
+
+
+def parse_status(data, properties, statuses=None):
+    """
+        Takes the contents of a dpkg status file
+
+        returns a list with a dictionary of the properties of every package
+        whose Status is in statuses, or of every package if it is None
+    """
+
+    # Only ever look at the fields that are kept
+    fields = re.compile(r"^(%s):[ \t]*([^\n]*)" % \
+                        "|".join([re.escape(key) for key in properties]), re.M)
+
+    packages = []
+    for offset, text in iter_stanzas(data):
+        # Most of the packages ever installed are usually long gone
+        match = status_field.search(text)
+        if not match or \
+           statuses is not None and not match.group(1).strip() in statuses:
+            continue
+
+        package = dict([(key, value.strip())
+                        for key, value in fields.findall(text)])
+        if "Package" in package:
+            packages.append(package)
+
+    return packages
+
+
+def journal_name(filename):
+    """
+        Returns the filename of the journal kept next to a saved status
+    """
+
+    return "%s.journal" % filename
+
+
+def journal_header(status):
+    """
+        Returns the first line of a journal kept for the saved status file,
+        which ties the journal to that exact snapshot
+    """
+
+    return "Snapshot: %i %s\n" % (os.path.getsize(status), file_digest(status))
+
+
+def read_journal(filename, properties, status):
+    """
+        Reads the stanzas appended to the journal of the saved status file
+
+        returns a list with a dictionary of the properties of each of them,
+        a stanza cut short by a crash is ignored and so is the whole journal
+        if it was started on a different snapshot of the status
+    """
+
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return []
+
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    # A journal left behind by an older snapshot holds changes the snapshot
+    # already has, replaying them would undo newer ones
+    header = journal_header(status)
+    if not data.startswith(header):
+        logging.debug("Ignoring outdated journal %s" % filename)
+        return []
+    data = data[len(header):]
+
+    # Only the stanzas followed by a blank line were written completely
+    end = data.rfind("\n\n")
+    if end == -1:
+        return []
+
+    return parse_status(data[:end + 2], properties)
+
+
+def apply_journal(packages, journal, statuses):
+    """
+        Returns packages with the stanzas of a journal applied in order, a
+        stanza whose Status is not in statuses removes the package
+    """
+
+    packages = list(packages)
+    index = dict([(package["Package"], i) for i, package in enumerate(packages)])
+
+    for entry in journal:
+        name = entry["Package"]
+        if entry["Status"] in statuses:
+            if name in index:
+                packages[index[name]] = entry
+            else:
+                index[name] = len(packages)
+                packages.append(entry)
+        elif name in index:
+            packages[index.pop(name)] = None
+
+    return [package for package in packages if package is not None]
+
+
+def append_journal(filename, stanzas, header=None):
+    """
+        Append stanzas to a status journal and make sure they reach the disk
+
+        With header a new journal is started instead, see journal_header
+    """
+
+    if header:
+        f = open(filename, "wb")
+        stanzas = [header] + stanzas
+    else:
+        f = open(filename, "ab")
+    try:
+        f.write("".join(stanzas))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+def write_status(filename, stanzas):
+    """
+        Replace the saved status filename with stanzas and drop its journal
+    """
+
+    # Write to a temporary file first so an interrupted save never leaves
+    # a truncated status behind
+    temp = "%s.tmp" % filename
+
+    f = open(temp, "wb")
+    try:
+        f.write("".join(stanzas))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(temp, filename)
+
+    # The journal belongs to the old snapshot, so read_journal ignores it
+    # if a crash leaves it behind
+    journal = journal_name(filename)
+    if os.path.exists(journal):
+        os.remove(journal)
+
+
+def format_stanza(fields):
+    """
+        Returns a list of (key, value) fields as a stanza
+    """
+
+    return "".join(["%s: %s\n" % field for field in fields]) + "\n"
+
+
+###############################################################################
+# Local Repository
+###############################################################################
+
+# Fields that are only meaningful to unwrapt
+local_fields = ["Long", "Status", "Repository"]
+
+
+def write_local_repository(directory, packages):
+    """
+        Make directory, which holds the downloaded packages, into a flat
+        repository of packages
+
+        returns the filename of a sources list for it
+    """
+
+    stanzas = []
+    for package in packages:
+        fields = []
+        for key in package.keys():
+            if key in local_fields:
+                continue
+
+            value = package[key]
+            if key == "Filename":
+                # The packages all sit at the top of the repository
+                value = value.rsplit("/", 1)[-1]
+            elif key == "Description" and "Long" in package:
+                value = "%s\n%s" % (value, package["Long"].rstrip("\n"))
+
+            fields.append((key, value))
+
+        stanzas.append(format_stanza(fields))
+
+    f = open(os.path.join(directory, "Packages"), "wb")
+    f.write("".join(stanzas))
+    f.close()
+
+    sources = os.path.join(directory, "sources.list")
+    f = open(sources, "wb")
+    f.write("deb [trusted=yes] file:%s ./\n" % directory)
+    f.close()
+
+    return sources
+
+
+###############################################################################
+# Dependency Parsing
+###############################################################################
+
+def provided_names(package):
+    """
+        Returns the names of the virtual packages a package provides
+    """
+
+    return [provide.strip().split(" ", 1)[0]
+            for provide in package["Provides"].split(",")]
+
+
+# A single option such as "libc6:any (>= 2.34)"
+relation = re.compile(r"^([^\s:(]+)(?::\S+)?\s*"
+                      r"(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^\s)]+)\s*\))?")
+
+# Obsolete comparisons dpkg still reads as their inclusive versions
+obsolete_comparisons = {"<": "<=", ">": ">="}
+
+
+def parse_relations(value):
+    """
+        Takes the value of a relationship field such as Depends
+
+        returns a list of groups of options, where each option is a tuple of
+        (name, comparison, DpkgVersion) and comparison and version are None
+        if any version will do
+    """
+
+    groups = []
+    for dep in value.split(","):
+        options = []
+
+        # In case we have some ORs
+        for option in dep.split("|"):
+            match = relation.match(option.strip())
+            if not match:
+                continue
+
+            name, comparison, version = match.groups()
+            if comparison:
+                comparison = obsolete_comparisons.get(comparison, comparison)
+                try:
+                    version = parse_version(version)
+                except VersionError, e:
+                    logging.debug("Ignoring version of %s: %s" % (option, e))
+                    comparison = version = None
+
+            options.append((intern(name), comparison, version))
+
+        if options:
+            groups.append(options)
+
+    return groups
+
+
+def format_relation(option):
+    """
+        Returns a (name, comparison, version) option as it is written in
+        the package lists
+    """
+
+    name, comparison, version = option
+    if not comparison:
+        return name
+
+    return "%s (%s %s)" % (name, comparison, version)
+
+
 ###############################################################################
 # The AptDef
 ###############################################################################
@@ -89,15 +536,28 @@ class Apt(DefinitionBase):
              "pass": None}
              
     packages = {}
+    versions = {}
+    latest = {}
+    providers = {}
+    candidate_keys = {}
+    reverse_depends = None
     status = {}
     supported = ["amd64", "armel", "i386", "ia64", "powerpc", "sparc"]
-    status_properties = ["Package", "Version", "Status", "Provides"]
+    status_properties = ["Package", "Version", "Status", "Provides",
+                         "Pre-Depends", "Depends", "Recommends"]
     binary_dependencies = ["Pre-Depends", "Depends", "Recommends"]
     supported_statuses = ["install ok installed", 
                           "to be downloaded",  
                           "dependency to be downloaded",
                           "to be installed", 
                           "dependency to be installed"]
+    pending_statuses = supported_statuses[1:]
+    saved_properties = ["Package", "Status", "Version", "Provides"]
+
+    # The filename and packages as of the last save, see on_save_changes
+    saved = None
+    journal_entries = 0
+    journal_limit = 1000
                       
 
     def on_set_architecture(self, architecture):
@@ -145,12 +605,14 @@ class Apt(DefinitionBase):
                 yield repo
 
 
-    def on_update(self, reporthook=None, callback=None, download=True):
+    def on_update(self, reporthook=None, callback=None, download=True, processes=1):
         """
             This is a missing docstring ZOMG!
             callback should be a tuple of the function, and any arguments to be passed
             
             callback=(glib.idle_add, self.function_to_call)
+
+            processes is the number of processes used to read the lists
         """
 
         if download:
@@ -160,7 +622,7 @@ class Apt(DefinitionBase):
 	    except Exception, e:
 		logging.error(e)
 
-        self._read_lists(reporthook)
+        self._read_lists(reporthook, processes)
 
         if callback:
             callback[0](*callback[1:])
@@ -187,24 +649,26 @@ class Apt(DefinitionBase):
             display_name = "Repository => %s / %s" % (repo["dist"], repo["section"])
 
             # Download
-            #TODO: catch exceptions
             #TODO: Support bz2 and unarchived Packages files
-	    filename = "%s.gz" % filename
+            filename = "%s.gz" % filename
             url_with_ext  = "%s.gz" % url
-	    #Checks the sources.list URL are valid and downloads the repo files
-            if httpExists(url_with_ext):
-            	download_url(url_with_ext,
-                                filename,
-                                display_name,
-                                progress=reporthook,
-                                proxy=self.proxy["proxy"],
-                                username=self.proxy["user"],
-                                password=self.proxy["pass"])
-            else:
-                logging.error("\nURL not exist: %s" % url_with_ext)
+            # A missing list only fails its own download
+            try:
+                download_url(url_with_ext,
+                             filename,
+                             display_name,
+                             progress=reporthook,
+                             proxy=self.proxy["proxy"],
+                             username=self.proxy["user"],
+                             password=self.proxy["pass"])
+            except IOError, e:
+                logging.error("\nUnable to download %s: %s" % (url_with_ext, e))
 
 
-    def _build_lists(self, directory, lists=[]):
+    def _build_lists(self, directory, lists=None):
+
+        if lists is None:
+            lists = []
 
         # Build the strings
         for repo in self.__iter_repositories():
@@ -216,9 +680,13 @@ class Apt(DefinitionBase):
         return lists
 
 
-    def _read_lists(self, reporthook=None):
+    def _read_lists(self, reporthook=None, processes=1):
         """
             on_update helper function
+
+            Lists that changed since they were last cached are parsed in a
+            pool of processes if processes, and the number of processors, is
+            greater than 1
         """
         
         def defaulthook(string):
@@ -234,125 +702,282 @@ class Apt(DefinitionBase):
             reporthook = defaulthook
         
         self.packages = {}        
-        lists = self._build_lists(os.path.join(self.download_directory, "lists"))
+        self.versions = {}
+        self.latest = {}
+        self.providers = {}
+        self.candidate_keys = {}
+        self.reverse_depends = None
+        directory = os.path.join(self.download_directory, "lists")
+        lists = self._build_lists(directory)
         total = len(lists)            
- 
-        # Now parse each file, extracting as necessary
-        for i, value in enumerate(lists):
-            repo, filename = value
 
+        def report(count):
             # Display percent read            
-            frac = (float(i)/float(total))*100
+            frac = (float(count)/float(total))*100
             reporthook("Reading package lists... %3i%%" % frac)
 
- 	    # Attempt to open the package list.
+        # Lists that have not changed since the last read come from the cache
+        cache = ListCache(directory)
+
+        read = {}
+        stale = []
+        for repo, filename in lists:
+            packages = cache.get(filename)
+            if packages is None:
+                stale.append(filename)
+            else:
+                read[filename] = packages
+
+        report(len(read))
+ 
+        # More processes than processors only adds to the work
+        try:
+            processes = min(processes, multiprocessing.cpu_count())
+        except NotImplementedError:
+            processes = 1
+
+        # Now parse each changed file, extracting as necessary
+        if processes > 1 and len(stale) > 1:
+            pool = multiprocessing.Pool(min(processes, len(stale)))
             try:
-                if filename.endswith(".gz"):
-                    f = gzip.open(filename, "rb")
-                else:
-                    f = open(filename, "rb")
-                # Parse packages into dictionary
-                self.__parse(repo, f)
-                f.close()
-            except IOError , ioex:
-                # Process the value of Errno and display the respective error message
-                if ioex.errno:
-                    # If Errno value is 2, then the file is not exists
-                    if ioex.errno == 2:
-                        logging.error("\nPackage list does not exist: %s" % filename)
-                else:
-                    logging.error("\n%s: %s" % (ioex,filename))
-                    # If we receive a corrupted package list delete it
-                    os.remove(filename)
-
-                #TODO: Redownload the corrupted list and hope that parses :)
+                results = pool.imap_unordered(read_list_stanzas, stale)
+                for filename, packages in results:
+                    if packages is not None:
+                        packages = make_records(filename,
+                                                marshal.loads(packages))
+                    read[filename] = packages
+                    report(len(read))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for filename in stale:
+                filename, packages = read_list(filename)
+                read[filename] = packages
+                report(len(read))
+
+        for filename in stale:
+            if read[filename] is not None:
+                cache.set(filename, read[filename])
+
+        # Merge in the order of the lists so the results never depend on
+        # which process finished first
+        for repo, filename in lists:
+            if read[filename] is not None:
+                self.__add_packages(repo, read[filename])
+
+        self.__sort_packages()
+
+        cache.prune()
+        cache.save()
 
         reporthook("Reading package lists... %3i%%" % 100)
         reporthook("")
         logging.info("%i packages available" % len(self.packages))
-        
 
-    def __parse(self, repo, f):
+
+    def __add_packages(self, repo, packages):
         """
-            Takes a repository and an open file
-            
-            returns a dictionary with all packages in file
-        """
-        
-        current = {}
-        for line in f:
-        
-            # Do we have a filled out package?
-            if line.startswith("\n"):
-                
-                # Attach
-                current["Repository"] = repo
-                if current["Package"] in self.packages:
-                    self.packages[current["Package"]].append(current)
-                else:
-                    self.packages[current["Package"]] = [current]
-
-                current = {}
-                    
-            # Do we have a long description?
-            elif line.startswith(" ") or line.startswith("\t"):
-                if "Long" in current:
-                    current["Long"] += line
-                else:
-                    current["Long"] = line
-
-            # Everything else is a standard property that gets handled the same
+            Attach the repository to each package and add it to self.packages,
+            the (name, version) index in self.versions and the providers of
+            each virtual package in self.providers
+        """
+
+        for package in packages:
+            package["Repository"] = repo
+            if package["Package"] in self.packages:
+                self.packages[package["Package"]].append(package)
             else:
-                try:
-                    key, value = line.split(": ", 1)
-                    current[key] = value.strip()
-                except Exception, e:
-                    logging.debug(repr(line))
-                    logging.debug(e)
-            
+                self.packages[package["Package"]] = [package]
+
+            # The first list a version appears in wins
+            key = (package["Package"], package["Version"])
+            if not key in self.versions:
+                self.versions[key] = package
+
+            if "Provides" in package:
+                for provide in provided_names(package):
+                    if provide in self.providers:
+                        self.providers[provide].append(package)
+                    else:
+                        self.providers[provide] = [package]
+        
 
-    def on_set_status(self, status="/var/lib/dpkg/status"):
+    def __sort_packages(self):
+        """
+            Sort the available packages of each name newest first and fill
+            self.latest with the newest of them
+        """
+
+        for name, available in self.packages.iteritems():
+            # Most packages only have a single version to choose from
+            if len(available) > 1:
+                available = sort_versions(available, reverse=True)
+                self.packages[name] = available
+
+            self.latest[name] = available[0]
+
+
+    def on_set_status(self, status="/var/lib/dpkg/status", merge=False):
         """
             Parses the dpkg status file for package versions, names, and
             installed statuses.
+
+            With merge the file is compared against the current statuses
+            instead, see __merge_status
         """
 
-        f = open(status, "rb")
-        
+        packages = read_status(status, self.status_properties,
+                               self.supported_statuses)
+
+        # Changes saved since the status was last written in full
+        journal = read_journal(journal_name(status), self.status_properties,
+                               status)
+        if journal:
+            packages = apply_journal(packages, journal,
+                                     self.supported_statuses)
+
+        if merge:
+            self.__merge_status(packages)
+            self.saved = None
+            return
+
         self.status = {}
-        
-        current = {}
-        for line in f:
-        
-            # Add package metadata to status
-            if line.startswith("\n") and "Package" in current:
-                
-                # Only add package if it is a supported status
-                if current["Status"] in self.supported_statuses:
-                    self.status[current["Package"]] = current
-                    
-                    # Mark the provides as well for dependency calculation
-                    if "Provides" in current:
-                        for provide in current["Provides"].split(", "):
-                            self.status[provide] = current
-                    
-                current = {}
-                
-            else:
-                # Add property
-                try:
-                    key, value = line.split(": ", 1)
-                    
-                    if key in self.status_properties:
-                        current[key] = value.strip()
-                except:
-                    pass
-        
-        f.close()
+        self.reverse_depends = None
+
+        for current in packages:
+            self.status[current["Package"]] = current
+
+        self.__add_provides(packages)
+
+        self.saved = (status, dict(self.__saved_state()))
+        self.journal_entries = len(journal)
         
         logging.info("%i packages installed" % len(self.status))
 
 
+    def __merge_status(self, packages):
+        """
+            Bring self.status up to date with the packages of a status file
+            without losing any marks
+
+            Packages whose version and status did not change are left alone.
+            A mark is only dropped once the marked version, or a newer one,
+            is installed.
+        """
+
+        fresh = dict([(current["Package"], current) for current in packages])
+        changed = 0
+
+        for name, current in fresh.iteritems():
+            previous = self.status.get(name)
+
+            if previous is not None and previous["Package"] == name:
+                if previous["Status"] in self.pending_statuses:
+                    # Keep the mark until it has been installed
+                    if current["Status"] != "install ok installed" or \
+                       parse_version(current["Version"]) < previous["Version"]:
+                        continue
+
+                elif previous["Version"] == current["Version"] and \
+                     previous["Status"] == current["Status"]:
+                    fresh[name] = previous
+                    continue
+
+            self.status[name] = current
+            changed += 1
+
+        # Forget removed packages, the entries for provided names are
+        # added again below
+        for name, previous in self.status.items():
+            if previous["Package"] != name:
+                del self.status[name]
+            elif not name in fresh and \
+                 not previous["Status"] in self.pending_statuses:
+                del self.status[name]
+                changed += 1
+
+        # In the order of the file, the first provider of a name wins
+        self.__add_provides([fresh[current["Package"]] for current in packages])
+
+        if changed:
+            self.reverse_depends = None
+
+        logging.info("%i package statuses changed" % changed)
+
+
+    def __add_provides(self, packages):
+        """
+            List packages in self.status under what they provide as well
+        """
+
+        for current in packages:
+            # Mark the provides as well for dependency calculation
+            if "Provides" in current:
+                for provide in provided_names(current):
+                    # Never hide an installed package of that name
+                    if not provide in self.status or \
+                       self.status[provide]["Package"] != provide:
+                        self.status[provide] = current
+
+
+    def on_get_reverse_dependencies(self, package):
+        """
+            Returns the available and installed packages that depend on
+            package or on any virtual package it provides
+        """
+
+        if self.reverse_depends is None:
+            self.__index_reverse_depends()
+
+        names = [package]
+        for metadata in [self.latest.get(package), self.status.get(package)]:
+            # The status also lists installed packages under what they provide
+            if metadata and metadata["Package"] == package and \
+               "Provides" in metadata:
+                names += provided_names(metadata)
+
+        found = []
+        seen = set()
+        for name in names:
+            for pkg in self.reverse_depends.get(name, []):
+                if not id(pkg) in seen:
+                    seen.add(id(pkg))
+                    found.append(pkg)
+
+        return found
+
+
+    def __index_reverse_depends(self):
+        """
+            Fill self.reverse_depends with the packages that depend on each
+            name, it is thrown away whenever the lists or status are read
+        """
+
+        index = {}
+        done = set()
+
+        def add(pkg):
+            done.add(id(pkg))
+            for options in self.on_get_package_dependencies(pkg):
+                for name, comparison, version in options:
+                    if name in index:
+                        index[name].append(pkg)
+                    else:
+                        index[name] = [pkg]
+
+        for available in self.packages.itervalues():
+            for pkg in available:
+                add(pkg)
+
+        # Installed packages may no longer be available, marked ones already are
+        for pkg in self.status.itervalues():
+            if not id(pkg) in done:
+                add(pkg)
+
+        self.reverse_depends = index
+
+
     def on_get_available_package_names(self):
         return self.packages.keys()
     
@@ -362,31 +987,23 @@ class Apt(DefinitionBase):
             Returns the data for latest version of a package
         """
         
-        available = self.get_available_binary_versions(package)
-        
-        if not available:
-            return None
-            
-        # Set the DpkgVersion instance for each package
-        for pkg in available:        
-            pkg["DpkgVersion"] = DpkgVersion(pkg["Version"])
-
-        # Compare the versions
-        newest = available[0]
-        for pkg in available[1:]:
-            if pkg["DpkgVersion"] > newest["DpkgVersion"]:
-                newest = pkg
-        
-        return newest
+        # The newest versions are found once each time the lists are read
+        return self.latest.get(package)
 
 
     def on_get_binary_version(self, package, version):
+
+        # Versions are almost always asked for exactly as they were read
+        key = (package, str(version))
+        if key in self.versions:
+            return self.versions[key]
         
         available = self.get_available_binary_versions(package)
         
-        # Return the metadata of the package with matching version
-	for package in available:
-            if DpkgVersion(package["Version"]) == version:
+        # Return the metadata of the package with matching version, this
+        # catches equal versions written differently such as 0:1.0 and 1.0
+        for package in available:
+            if parse_version(package["Version"]) == version:
                 return package
         
         return None
@@ -395,7 +1012,7 @@ class Apt(DefinitionBase):
     def on_get_available_binary_versions(self, package):
         """
             Return a list of metadata for all available packages with a
-            matching name
+            matching name, newest first
         """
         
         if not package in self.packages:
@@ -406,88 +1023,264 @@ class Apt(DefinitionBase):
 
     def on_mark_package(self, metadata, dependency=False):
         """
-            Get a list of dependencies based on package metadata
+            Mark a package and its dependencies, returns a list of every
+            package marked
+        """
+
+        self.__check_markable(metadata)
+
+        marked = []
+        self.__resolve(metadata, dependency, marked, set(),
+                       self.__pending_provided())
+        return marked
+
+
+    def on_mark_packages(self, packages):
+        """
+            Mark a list of packages and their dependencies in a single pass
+
+            returns a dictionary of the names of the packages that could not
+            be marked and why
+        """
+
+        failures = {}
+
+        # Dependencies shared by the packages are only looked at once
+        marked = []
+        visited = set()
+        provided = self.__pending_provided()
+        for metadata in packages:
+            try:
+                self.__check_markable(metadata)
+            except AttributeError, e:
+                name = metadata and metadata.get("Package")
+                failures[name] = str(e)
+                continue
+
+            self.__resolve(metadata, False, marked, visited, provided)
+
+        logging.info("Marked %i packages" % len(marked))
+        return failures
+
+
+    def on_mark_all_upgrades(self):
+        """
+            Mark every upgrade and its new dependencies in a single pass,
+            returns a list of every package marked
+        """
+
+        # The upgrades are known to be installed and out of date, so they
+        # skip the checks a package passed in by the caller needs
+        marked = []
+        visited = set()
+        provided = self.__pending_provided()
+        for latest in self.on_get_upgrades():
+            self.__resolve(latest, False, marked, visited, provided)
+
+        logging.info("Marked %i packages" % len(marked))
+        return marked
+
+
+    def __check_markable(self, metadata):
+        """
+            Raises AttributeError if a package cannot be marked
         """
 
         if not metadata:
             raise AttributeError, "You must supply valid package metadata"
 
-        #TODO: This function obviously needs to be split up and modularized :)
-
         # First check if the package is installed already?
         if self.__is_installed(metadata["Package"]) and \
            not self.__is_upgradable(metadata["Package"]):
             raise AttributeError, "Package %s is already %s." % (metadata["Package"], self.get_package_status(metadata["Package"]))
-        
-        # Mark the package itself
-        if not dependency: metadata["Status"] = "to be downloaded"
-        else: metadata["Status"] = "dependency to be downloaded"
-        self.status[metadata["Package"]] = metadata
 
-        logging.info("Finding dependencies for %s..." % metadata["Package"])
 
-        depends = self.on_get_package_dependencies(metadata)
-        
-        # Do the dependency calculations
-        for dep in depends:
-            
-            # In case we have some ORs
-            options = dep.split(" | ")
-            
-            satisfied = False
-            for option in options:
-            
-                details = option.split(" ")
-                name = details[0]
-                
-                # If any of these packages are already installed
-                if name in self.status:
-                    #logging.debug("Dependency %s installed!" % name)
-
-                    # Assume installed version will work
-                    satisfied = True
-                    
-                    # Test for compatible version just in case
-                    if len(details) > 1:
-                        comparison = details[1][1:] # strip the '('
-                        version = details[2][:-1] # strip the ')'
-                        
-                        satisfied = DpkgVersion(self.status[name]["Version"]). \
-                                            compare_string(comparison, version)
-                        
-                    # No need to test the other options if one is found
-                    if satisfied:
-                        break
-                          
-            # No package was installed, so take the first one and add it
-            # as a dependency
-            if not satisfied:
-
-                name = options[0].split(" ", 1)[0]
-                pkg = self.get_latest_binary(name)
-
-                #TODO: Verify pkg's version satisfies
-                #pkg["Status"] = "to be downloaded"
-                #self.status[pkg["Package"]] = pkg
-                #print pkg
-                
-                # Mark sub-dependencies as well
-                if pkg:
-                    self.on_mark_package(pkg, dependency=True)
+    def __pending_provided(self):
+        """
+            Returns the virtual packages provided by the packages that are
+            already marked, to start the provided set of a new pass with
+        """
+
+        provided = set()
+        for name, pkg in self.status.iteritems():
+            if pkg["Package"] == name and "Provides" in pkg and \
+               pkg["Status"] in self.pending_statuses:
+                provided.update(provided_names(pkg))
+
+        return provided
+
+
+    def __resolve(self, metadata, dependency, marked, visited, provided):
+        """
+            Mark a package and everything it needs, adding the packages it
+            marks to marked, their names to visited and the virtual packages
+            they provide to provided
+        """
+
+        def mark(pkg, dependency):
+            # Mark the package itself
+            if not dependency: pkg["Status"] = "to be downloaded"
+            else: pkg["Status"] = "dependency to be downloaded"
+            self.status[pkg["Package"]] = pkg
+
+            marked.append(pkg)
+            visited.add(pkg["Package"])
+            if "Provides" in pkg:
+                provided.update(provided_names(pkg))
+
+            logging.info("Finding dependencies for %s..." % pkg["Package"])
+            return iter(self.on_get_package_dependencies(pkg))
+
+        # Already pulled in by an earlier package of the same pass
+        if metadata["Package"] in visited and \
+           self.status.get(metadata["Package"]) is metadata:
+            if not dependency:
+                metadata["Status"] = "to be downloaded"
+            return
+
+        # Walk the dependencies depth first like a recursive mark would, with
+        # the dependencies of every package being marked kept on a stack
+        stack = [mark(metadata, dependency)]
+        while stack:
+            for options in stack[-1]:
+                pkg = self.__unsatisfied(options, visited, provided)
+                if pkg is not None:
+                    stack.append(mark(pkg, True))
+                    break
+            else:
+                stack.pop()
+
+
+    def __unsatisfied(self, options, visited, provided):
+        """
+            Returns the package to mark for a group of options, None if one
+            of them is already installed or marked
+
+            provided holds the virtual packages provided by the packages
+            marked so far, this pass or an earlier one
+        """
+
+        for name, comparison, version in options:
+            # If any of these packages are already installed
+            if name in self.status:
+                # Assume installed version will work, unless the version
+                # is given
+                if not comparison or \
+                   parse_version(self.status[name]["Version"]). \
+                       compare_string(comparison, version):
+                    return None
+
+            elif name in provided:
+                return None
+
+        # Nothing is installed, so take the first option with a version that
+        # satisfies it and add it as a dependency
+        for name, comparison, version in options:
+            # Already marked in this pass, marking it again could go on forever
+            if name in visited:
+                continue
+
+            # Marked by an earlier pass at a version that does not satisfy
+            # this, replacing it would break whatever it was marked for
+            if self.__is_pending(name):
+                continue
+
+            pkg = self.__get_candidate(name, comparison, version)
+
+            # A virtual package, mark whichever package provides it first
+            if pkg is None and not comparison and name in self.providers:
+                provider = self.providers[name][0]["Package"]
+                if not provider in visited and \
+                   not self.__is_installed(provider) and \
+                   not self.__is_pending(provider):
+                    pkg = self.get_latest_binary(provider)
+
+            if pkg is None:
+                continue
+
+            # Never go back to an older version than the one installed
+            if self.__is_installed(pkg["Package"]) and \
+               not parse_version(pkg["Version"]) > \
+                   self.status[pkg["Package"]]["Version"]:
+                continue
+
+            return pkg
+
+        logging.warning("Unable to satisfy dependency on %s" % \
+                        " | ".join([format_relation(option)
+                                    for option in options]))
+        return None
+
+
+    def __get_candidate(self, name, comparison=None, version=None):
+        """
+            Returns the newest available package called name whose version
+            satisfies the comparison, None if there is none
+        """
+
+        available = self.packages.get(name)
+        if not available:
+            return None
+
+        newest = available[0]
+        if not comparison:
+            return newest
+
+        # Either the newest version will do or none will
+        if comparison in [">=", ">>"]:
+            if parse_version(newest["Version"]).compare_string(comparison,
+                                                               version):
+                return newest
+            return None
+
+        # Find the newest version below the limit among the versions sorted
+        # oldest first, equal versions keep the package from the first list
+        keys = self.candidate_keys.get(name)
+        if keys is None:
+            keys = [parse_version(pkg["Version"]).key
+                    for pkg in reversed(available)]
+            self.candidate_keys[name] = keys
+
+        if comparison == "<<":
+            idx = bisect.bisect_left(keys, version.key) - 1
+        else:
+            idx = bisect.bisect_right(keys, version.key) - 1
+
+        if idx < 0 or (comparison == "=" and keys[idx] != version.key):
+            return None
+
+        return available[len(available) - 1 - idx]
 
 
     def on_get_package_dependencies(self, metadata):
+        """
+            Returns the dependencies of a package as a list of groups of
+            options, see parse_relations
 
-        # Build a string of the necessary sections we need
+            The groups are kept on the package so they are only parsed once
+        """
+
+        try:
+            return metadata._depends
+        except AttributeError:
+            pass
+
+        # Parse the necessary sections we need
         depends = []
         for section in self.binary_dependencies:
             if section in metadata:
-                depends += metadata[section].split(", ")
+                depends += parse_relations(metadata[section])
+
+        # Only PackageRecords have room to keep them
+        try:
+            metadata._depends = depends
+        except AttributeError:
+            pass
 
         return depends
 
 
-    def on_apply_changes(self, reporthook=None, callback=None):
+    def on_apply_changes(self, reporthook=None, callback=None, workers=4):
 
         if not reporthook:
             reporthook = textprogress        
@@ -495,38 +1288,37 @@ class Apt(DefinitionBase):
         directory = os.path.join(self.download_directory, "packages")
         
         # Build the list of package urls to download
-	packages = [(key, self.get_binary_version(value["Package"], value["Version"])) \
-	            for key, value in self.status.items() \
-		    if value["Status"] in ["to be downloaded", "dependency to be downloaded"]]
+        packages = [(key, self.get_binary_version(value["Package"], value["Version"])) \
+                    for key, value in self.status.items() \
+                    if value["Status"] in ["to be downloaded", "dependency to be downloaded"]]
 
-        downloads = [(key, value["Repository"]["url"].split("dists")[0] + value["Filename"]) \
+        downloads = [(key, value["Repository"]["url"].split("dists")[0] + value["Filename"], int(value["Size"])) \
                      for key, value in packages]
         
-        #downloads = []
-        #for key, value in self.status.items():
-        #    if value["Status"] == "to be downloaded":
-        #        downloads.append(value["Repository"]["url"].split("dists")[0] + value["Filename"])
-                
         logging.info("%i packages to be installed" % len(downloads))
         
         # Create the download directory if it doesn't exist
         if not os.path.exists(directory):
             os.mkdir(directory)
-        
-        # Download the files
-        for key, url in downloads:
-            download_url(url, 
-                         "%s/%s" % (directory, url.rsplit("/", 1)[1]), 
-                         progress=reporthook,
-                         proxy=self.proxy["proxy"], 
-                         username=self.proxy["user"], 
-                         password=self.proxy["pass"])
+
+        def finished(index):
             # Once it's downloaded, mark this package status to "to be installed"
             # or "dependency to be installed", depending on what it is now.
+            key = downloads[index][0]
             if self.status[key]["Status"] == "to be downloaded":
                 self.status[key]["Status"] = "to be installed"
             elif self.status[key]["Status"] == "dependency to be downloaded":
                 self.status[key]["Status"] = "dependency to be installed"
+        
+        # Download the files, several at a time
+        download_urls([(url, "%s/%s" % (directory, url.rsplit("/", 1)[1]), size) \
+                       for key, url, size in downloads],
+                      progress=reporthook,
+                      proxy=self.proxy["proxy"], 
+                      username=self.proxy["user"], 
+                      password=self.proxy["pass"],
+                      workers=workers,
+                      finished=finished)
 
         if callback:
             callback[0](*callback[1:])
@@ -537,19 +1329,53 @@ class Apt(DefinitionBase):
         # This will NOT create a status file to override /var/lib/dpkg/status
         # so DO NOT try to replace the system status file.
         # YOU HAVE BEEN WARNED
-        
-        f = open(status, "wb")
-        
-        for status, package in self.status.items():
 
-            # Try to write these back in the order they were read
-            properties = ["Package", "Status", "Version", "Provides"]
-            lines = ["%s: %s\n" % (key, package[key]) for key in properties if key in package]
-            
-            f.writelines(lines)
-            f.write("\n")
-            
-        f.close()
+        packages = self.__saved_state()
+        current = dict(packages)
+
+        # Saving again to the same file only appends the packages that changed
+        # to its journal, until the journal is long enough to be folded back
+        # into the status
+        if self.saved and self.saved[0] == status and os.path.exists(status):
+            saved = self.saved[1]
+
+            changes = [format_stanza(fields)
+                       for name, fields in packages if saved.get(name) != fields]
+            changes += [format_stanza([("Package", name),
+                                       ("Status", "purge ok not-installed")])
+                        for name in saved if not name in current]
+
+            if self.journal_entries + len(changes) <= self.journal_limit:
+                if changes:
+                    # Start a new journal unless one for this snapshot is
+                    # already being kept
+                    header = None
+                    if not self.journal_entries:
+                        header = journal_header(status)
+
+                    append_journal(journal_name(status), changes, header)
+                    self.journal_entries += len(changes)
+
+                self.saved = (status, current)
+                return
+
+        write_status(status, [format_stanza(fields) for name, fields in packages])
+        self.journal_entries = 0
+        self.saved = (status, current)
+
+
+    def __saved_state(self):
+        """
+            Returns a list of the name and saved fields of every package
+        """
+
+        # Try to write these back in the order they were read, the entries
+        # for provided names are left out
+        return [(name, tuple([(key, package[key])
+                              for key in self.saved_properties
+                              if key in package]))
+                for name, package in self.status.iteritems()
+                if package["Package"] == name]
         
         
     def on_cancel_changes(self, downloads, installs):
@@ -598,7 +1424,7 @@ class Apt(DefinitionBase):
         return None
         
         
-    def on_install(self, reporthook=None, callback=None, root="gksu", status="/var/lib/dpkg/status"):
+    def on_install(self, reporthook=None, callback=None, root="gksu", status="/var/lib/dpkg/status", local_repository=False):
         """
             We will take the approach of installing by copying the lists to
             /var/lib/apt/lists and the packages to /var/cache/apt/archives and
@@ -606,63 +1432,129 @@ class Apt(DefinitionBase):
             which have the status of "to be installed". This prevents tampering
             with sources.list and works more or less the exact same if we made
             a local repository.
+
+            With local_repository the packages folder is made into a flat
+            repository of just the marked packages instead, which apt reads in
+            place without touching the system lists or archives.
+
+            Either way everything that needs root is done by InstallHelper in
+            a single run, so the password is only asked for once.
         """
 
-	def subproc(command):
-	    if reporthook:
-		reporthook(command)
+        marked = [value for key, value in self.status.items()
+                  if value["Package"] == key and value["Status"] in
+                  ["to be installed", "dependency to be installed"]]
 
-	    logging.info(command)
-	    return subprocess.call(command, shell=True)
+        # A saved status only has the name and version of the packages
+        packages = [self.get_binary_version(value["Package"], value["Version"])
+                    for value in marked]
 
-        # Copy lists over
-        for repo in self.__iter_repositories():
-            url = to_url(repo, self.architecture, "Packages")
-            source = to_filename(os.path.join(self.download_directory, "lists"), url)
-	    dest = to_filename("/var/lib/apt/lists", url)
+        manifest = {"install": [value["Package"] for value in marked
+                                if value["Status"] == "to be installed"]}
 
-	    subproc("%s \"sh -c 'zcat %s.gz > %s'\"" % (root, source, dest))
+        if local_repository:
+            directory = os.path.abspath(os.path.join(self.download_directory,
+                                                     "packages"))
+            sources = write_local_repository(directory, packages)
 
+            # Only ever look at the local repository, and leave the lists of
+            # the system repositories where they are
+            manifest["options"] = ["Dir::Etc::SourceList=%s" % sources,
+                                   "Dir::Etc::SourceParts=-",
+                                   "APT::Get::List-Cleanup=0",
+                                   "APT::Get::AllowUnauthenticated=true",
+                                   "Acquire::AllowInsecureRepositories=true"]
+            manifest["update"] = True
 
-        # Copy packages over
-	files = []
-        for value in self.status.values():
-            if value["Status"] in ["to be installed", "dependency to be installed"]:
-                pkg_filename = self.get_binary_version(value["Package"], value["Version"])["Filename"].rsplit("/", 1)[1]
-                files.append(os.path.join(self.download_directory, "packages", pkg_filename))
+        else:
+            # Copy the lists and packages over
+            manifest["lists"] = []
+            for repo in self.__iter_repositories():
+                url = to_url(repo, self.architecture, "Packages")
+                source = to_filename(os.path.join(self.download_directory, "lists"), url)
+                source = "%s.gz" % os.path.abspath(source)
+
+                # Lists that failed to download are left out
+                if os.path.exists(source):
+                    manifest["lists"].append((source,
+                                              to_filename("/var/lib/apt/lists", url)))
+
+            manifest["packages"] = [os.path.abspath(os.path.join(
+                                        self.download_directory, "packages",
+                                        package["Filename"].rsplit("/", 1)[1]))
+                                    for package in packages]
+            manifest["gencaches"] = True
+
+        self.__run_helper(manifest, root, reporthook)
+
+        # Update the status after installation, anything that failed to
+        # install is still marked
+        self.set_status(status, merge=True)
 
-	subproc("%s \"sh -c 'cp %s /var/cache/apt/archives/'\"" % (root, " ".join(files)))
- 
+        if callback:
+            callback[0](*callback[1:])
 
-        # Call apt-get install with the packages
-        packages = [value["Package"] for key, value in self.status.items() if value["Status"] == "to be installed"]
-        
 
-	subproc("%s apt-cache gencaches" % root)
-        subproc("%s \"sh -c 'apt-get install -y %s'\"" % (root, " ".join(packages)))
-        
-        # Update the status after installation
-        self.set_status(status)
-        
-	if callback:
-	    callback[0](*callback[1:])
+    def __run_helper(self, manifest, root, reporthook=None):
+        """
+            Run InstallHelper on manifest as root, asking for the password
+            only once, and pass each line of its progress to reporthook
+
+            returns the exit status of the helper
+        """
+
+        filename = os.path.abspath(os.path.join(self.download_directory,
+                                                "install.manifest"))
+        f = open(filename, "wb")
+        json.dump(manifest, f)
+        f.close()
+
+        helper = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "InstallHelper.py")
+        command = "%s \"%s -u %s %s\"" % (root, sys.executable, helper,
+                                           filename)
+        logging.info(command)
+
+        process = subprocess.Popen(command, shell=True,
+                                   stdout=subprocess.PIPE)
+        for line in iter(process.stdout.readline, ""):
+            line = line.rstrip("\n")
+            logging.info(line)
+            if reporthook:
+                reporthook(line)
+
+        result = process.wait()
+        if result:
+            logging.error("Installation failed with exit status %i" % result)
+
+        return result
 
 
     def on_get_upgrades(self):
         
         upgrades = []
+        seen = set()
         
         # We will only check the installed packages, anything to be downloaded
         # or installed can wait. We might want to change this in the future.
-        installed = [value for key, value in self.status.items() if value["Status"] == "install ok installed"]
-        
-        for current in installed:
-            latest = self.get_latest_binary(current["Package"])
+        for current in self.status.itervalues():
+            if current["Status"] != "install ok installed":
+                continue
+
+            # Packages are also listed under each name they provide, only
+            # look at every installed package once
+            if id(current) in seen:
+                continue
+            seen.add(id(current))
+
+            latest = self.latest.get(current["Package"])
             
             # Only if there is a version available should we check to see if
             # there is a newer version. We also don't want to mark it twice if
             # the package is already selected for upgrade
-            if latest and latest not in upgrades and DpkgVersion(latest["Version"]) > DpkgVersion(current["Version"]):
+            if latest and not id(latest) in seen and \
+               parse_version(latest["Version"]) > parse_version(current["Version"]):
+                seen.add(id(latest))
                 upgrades.append(latest)
 
         return upgrades
@@ -684,6 +1576,12 @@ class Apt(DefinitionBase):
         return True
 
 
+    def __is_pending(self, package):
+        """Take a package name, returns True if marked, False otherwise."""
+
+        return self.on_get_package_status(package) in self.pending_statuses
+
+
     def __is_upgradable(self, package):
         """Takes a package name, returns True if installed and out-of-date, 
            False otherwise.
@@ -693,7 +1591,7 @@ class Apt(DefinitionBase):
             return False  #FIXME: should we raise an error?
         current = self.status[package]
         latest = self.get_latest_binary(package)
-        if latest and DpkgVersion(latest["Version"]) > DpkgVersion(current["Version"]):
+        if latest and parse_version(latest["Version"]) > parse_version(current["Version"]):
             return True
         else:
             return False
@@ -1,6 +1,7 @@
 import gzip
 import os
 from Download import *
+from StanzaReader import read_stanzas
 
 def url_join(*args):
     return "/".join([x.strip("/") for x in args])
@@ -88,23 +89,15 @@ class Unwrapt:
 
 
     def __parse_packages_file(self, repo, f):
-        package = {}
-
-        for line in f:
-            # Package is finished parsing
-            if line.startswith("\n"):
-                package["Repository"] = repo
-                self.__add_package(package)
-                package = {}
+        data = f.read()
 
+        for offset, package, span in read_stanzas(data):
             # Long description
-            elif line.startswith(" ") or line.startswith("\t"):
-                if "Long" in package: package["Long"] += line
-                else:                 package["Long"] = line
+            if span:
+                package["Long"] = data[offset + span[0]:offset + span[1]]
 
-            else:
-                key, value = line.split(": ", 1)
-                package[key] = value.strip()
+            package["Repository"] = repo
+            self.__add_package(package)
 
 
     def __add_package(self, package):
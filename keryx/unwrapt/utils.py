@@ -16,6 +16,8 @@
 
 import os
 
+from collections import OrderedDict
+
 
 def url_join(*args):
     """ Returns full URL """
@@ -79,3 +81,54 @@ def format_number(number, SI=0, space=' '):
         format = '%.0f%s%s'
         
     return(format % (float(number or 0), space, symbols[depth]))
+
+
+class LRUCache:
+    """
+        A dictionary that only keeps the maxsize most recently used items
+
+        Lookups through get are counted in hits and misses
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __getitem__(self, key):
+        # Move the item to the end so it is the last to be thrown away
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.maxsize:
+            self.items.popitem(last=False)
+
+        self.items[key] = value
+
+
+    def get(self, key, default=None):
+        if not key in self.items:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return self[key]
+
+
+    def __contains__(self, key):
+        return key in self.items
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def clear(self):
+        self.items.clear()